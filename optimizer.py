@@ -1,9 +1,74 @@
 import copy
+import concurrent.futures
 import machupX as mx
 import numpy as np
 import scipy.optimize as opt
 
 
+def reduce_section_forces(Fx, Fy, Fz, dS, c, alpha, q_inf, CL_c_ref):
+    """Reduces section forces from MachUpX to section drag coefficients and the load distribution.
+
+    Parameters
+    ----------
+    Fx, Fy, Fz : ndarray
+        Section forces in the body frame.
+
+    dS : ndarray
+        Section areas.
+
+    c : ndarray
+        Section chords.
+
+    alpha : float
+        Angle of attack in degrees.
+
+    q_inf : float
+        Freestream dynamic pressure.
+
+    CL_c_ref : float
+        Product of the wing lift coefficient and the reference chord, used to normalize the load.
+
+    Returns
+    -------
+    CD : ndarray
+        Section drag coefficients.
+
+    load : ndarray
+        Load distribution.
+    """
+
+    # Get trig functions of alpha and nondimensionalization
+    a = np.radians(alpha)
+    C_a = np.cos(a)
+    S_a = np.sin(a)
+    inv_non_dim = 1.0/(q_inf*dS)
+
+    # Get CD
+    CD = (-Fx*C_a-Fz*S_a)*inv_non_dim
+
+    # Calculate Cn and load distribution
+    load = np.sqrt(Fz*Fz+Fy*Fy)*inv_non_dim*c/CL_c_ref
+
+    return CD, load
+
+
+# Optimizer owned by each worker process when evaluating in parallel
+_worker_optimizer = None
+
+
+def _init_worker(wing_input, V, rho, N_twist_stations, CL, N_modes):
+    # Sets up a separate optimizer (and MachUpX scene) in a worker process
+    global _worker_optimizer
+    _worker_optimizer = TwistOptimizer(wing_input, V, rho)
+    _worker_optimizer._set_up_problem(N_twist_stations, CL, N_modes)
+
+
+def _worker_induced_drag(x, alpha):
+    # Calculates the induced drag in a worker process, starting from the given angle of attack
+    _worker_optimizer.alpha = alpha
+    return _worker_optimizer._get_induced_drag(x)
+
+
 class TwistOptimizer:
     """Uses MachUpX and scipy.optimize to optimize the twist distribution on a given wing for minimum induced drag.
 
@@ -17,12 +82,15 @@ class TwistOptimizer:
 
     rho : float
         Atmospheric density.
+
+    optimizer : str, optional
+        Optimization algorithm to use. May be "slsqp" (scipy.optimize SLSQP with finite-difference gradients) or "cma" (derivative-free CMA-ES, which evaluates each population as a batch; requires the cma package). Defaults to "slsqp".
     """
 
-    def __init__(self, wing_input, V, rho):
+    def __init__(self, wing_input, V, rho, optimizer="slsqp"):
 
-        # Store
-        self._wing_input = wing_input
+        # Store a private copy so the caller's dict is never shared with MachUpX
+        self._wing_input = copy.deepcopy(wing_input)
         try:
             self._wing_input["wings"]["design_section"]
         except KeyError:
@@ -32,9 +100,23 @@ class TwistOptimizer:
         self._V = V
         self._rho = rho
 
+        # Check optimizer
+        self._optimizer = optimizer.lower()
+        if self._optimizer not in ["slsqp", "cma"]:
+            raise IOError("{0} is not an allowable optimizer. Must be 'slsqp' or 'cma'.".format(optimizer))
+
+        # Set up MachUpX scene; only the aircraft is replaced as the twist changes
+        self._scene = mx.Scene({"scene" : {"atmosphere" : {"density" : self._rho}}})
+
+        # Optimum from the previous call to optimize(), used as a warm start
+        self._twist_opt = None
+
+        # Last converged angle of attack, used to start the search for the target CL
+        self.alpha = 0.0
 
-    def optimize(self, N_twist_stations, CL):
-        """Optimizes the twist.
+
+    def optimize(self, N_twist_stations, CL, ftol=1e-6, n_workers=1, N_modes=None):
+        """Optimizes the twist. If optimize() has already been called with the same number of twist stations (e.g. in a sweep over CL), the previous optimum is used as the initial guess.
 
         Parameters
         ----------
@@ -44,6 +126,15 @@ class TwistOptimizer:
         CL : float
             Lift coefficient at which to minimize drag.
 
+        ftol : float, optional
+            Precision goal on the (amplified) objective used to terminate the optimizer. Loosening this stops the optimizer once the change in induced drag becomes insignificant. Defaults to 1e-6.
+
+        n_workers : int, optional
+            Number of processes used to evaluate the finite-difference gradient (SLSQP) or each population (CMA-ES) in parallel. Each process sets up its own MachUpX scene. Defaults to 1 (serial).
+
+        N_modes : int, optional
+            If given, the twist at the stations is parameterized by this many Chebyshev polynomials in span and the optimizer varies their coefficients rather than the station twist values directly. A few modes are sufficient for the smooth optimum twist and reduce the cost of each iteration. Defaults to parameterizing the twist at each station directly.
+
         Returns
         -------
         s : ndarray
@@ -54,37 +145,128 @@ class TwistOptimizer:
         """
 
         # Store
-        self._N = N_twist_stations
-        self._CL = CL
+        self._set_up_problem(N_twist_stations, CL, N_modes)
+
+        # Start worker processes
+        if n_workers > 1:
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(self._wing_input, self._V, self._rho, self._N, self._CL, N_modes))
+        else:
+            self._pool = None
+
+        # Get initial guess
+        if self._twist_opt is not None and len(self._twist_opt) == self._N:
+            twist0 = np.copy(self._twist_opt)
+        else:
+            twist0 = np.zeros(self._N)
+        if self._basis is not None:
+            x0 = np.linalg.lstsq(self._basis, twist0, rcond=None)[0]
+        else:
+            x0 = twist0
 
         # Optimize
-        twist0 = np.zeros(self._N)
-        result = opt.minimize(self._get_induced_drag, twist0, method='SLSQP', options={'eps' : 0.01, 'disp' : True})
-        twist = result.x
-        self.C_D = result.fun/1000.0
+        self._eps = 0.01
+        try:
+            if self._optimizer == "cma":
+                x = self._optimize_cma(x0, ftol, n_workers)
+            else:
+                result = opt.minimize(self._get_induced_drag, x0, method='SLSQP', jac=self._grad_induced_drag, options={'ftol' : ftol, 'disp' : True})
+                x = result.x
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+        # Leave the scene at the optimum, as SLSQP's last evaluation may have been a perturbed point
+        self.C_D = self._solve_induced_drag(x)/1000.0
+        twist = np.copy(self._twist_array[:,1])
+        self._twist_opt = np.copy(twist)
 
         # Determine span array
-        s = np.linspace(0.0, 0.5, self._N)
+        s = 0.5*self._twist_array[:,0]
 
         return s, twist
 
 
-    def _get_induced_drag(self, twist):
-        # Calculates the induced drag for the given twist distribution
+    def _optimize_cma(self, x0, ftol, n_workers):
+        # Minimizes the induced drag using CMA-ES, evaluating each population as a batch
+        import cma
 
-        # Determine twist array
-        s = np.linspace(0.0, 1.0, self._N)
-        twist_array = np.concatenate((s[:,np.newaxis], twist[:,np.newaxis]), axis=1)
+        # Use at least one candidate per worker
+        popsize = max(n_workers, 4+int(3*np.log(len(x0))))
+        es = cma.CMAEvolutionStrategy(x0, 1.0, {'popsize' : popsize, 'tolfun' : ftol})
 
-        # Update wing dict
-        wing_dict = copy.deepcopy(self._wing_input)
-        wing_dict["wings"]["design_section"]["twist"] = twist_array
+        # Iterate
+        while not es.stop():
+            xs = es.ask()
+            es.tell(xs, self._evaluate_batch(xs))
+            es.disp()
 
-        # Set up MachUpX
-        self._scene = mx.Scene({"scene" : {"atmosphere" : {"density" : self._rho}}})
-        self._scene.add_aircraft("wing", wing_dict, state={"velocity" : self._V})
+        return np.array(es.result.xbest)
 
-        # Go to target CL
+
+    def _set_up_problem(self, N_twist_stations, CL, N_modes=None):
+        # Stores the problem parameters and allocates the twist array
+
+        # Store
+        self._N = N_twist_stations
+        self._CL = CL
+
+        # Allocate twist array; the span fractions are fixed and only the twist column is updated
+        self._twist_array = np.empty((self._N, 2))
+        self._twist_array[:,0] = np.linspace(0.0, 1.0, self._N)
+
+        # Solutions for this problem, keyed by design point
+        self._cache = {}
+
+        # Get Chebyshev basis mapping mode coefficients to station twist
+        if N_modes is not None:
+            self._basis = np.polynomial.chebyshev.chebvander(2.0*self._twist_array[:,0]-1.0, N_modes-1)
+        else:
+            self._basis = None
+
+
+    def _get_induced_drag(self, x):
+        # Returns the induced drag for the given design variables, reusing previous solutions at the same point
+        key = self._cache_key(x)
+        try:
+            return self._cache[key]
+        except KeyError:
+            C_D = self._solve_induced_drag(x)
+            self._cache[key] = C_D
+            return C_D
+
+
+    def _cache_key(self, x):
+        # Rounding makes points which differ only by roundoff share a key
+        return np.round(np.asarray(x, dtype=float), 12).tobytes()
+
+
+    def _solve_induced_drag(self, x):
+        # Calculates the induced drag for the given design variables (station twist or Chebyshev coefficients)
+
+        # Determine twist array
+        # The twist is given per semispan (root to tip); MachUpX mirrors it onto the
+        # left side for "side" : "both", so the design variables already exploit symmetry
+        twist_array = self._twist_array
+        if self._basis is not None:
+            twist_array[:,1] = self._basis.dot(x)
+        else:
+            twist_array[:,1] = x
+
+        # Update wing dict, copying only the path to the design section twist
+        design_section = dict(self._wing_input["wings"]["design_section"])
+        design_section["twist"] = twist_array
+        wings = dict(self._wing_input["wings"])
+        wings["design_section"] = design_section
+        wing_dict = dict(self._wing_input)
+        wing_dict["wings"] = wings
+
+        # Replace the wing in the MachUpX scene
+        if "wing" in self._scene._airplanes:
+            self._scene.remove_aircraft("wing")
+        self._scene.add_aircraft("wing", wing_dict, state={"velocity" : self._V, "alpha" : self.alpha})
+
+        # Go to target CL, starting from the last converged angle of attack
         self.alpha = self._scene.target_CL(CL=self._CL, set_state=True)
 
         # Get total drag on design section and winglets
@@ -93,6 +275,40 @@ class TwistOptimizer:
         return C_D*1000.0 # Amplifying this objective function helps the optimizer converge
 
 
+    def _grad_induced_drag(self, x):
+        # Calculates the gradient of the induced drag with respect to the design variables using forward differences
+        # MachUpX does not provide sensitivities, so this takes one solution per design variable
+
+        # Get base value; SLSQP has usually just evaluated this point
+        C_D0 = self._get_induced_drag(x)
+
+        # Perturb each design variable
+        xs = []
+        for i in range(len(x)):
+            x_i = np.copy(x)
+            x_i[i] += self._eps
+            xs.append(x_i)
+
+        return (np.array(self._evaluate_batch(xs))-C_D0)/self._eps
+
+
+    def _evaluate_batch(self, xs):
+        # Calculates the induced drag for each of a list of design points, in parallel if workers are available
+        if self._pool is None:
+            return [self._get_induced_drag(np.asarray(x)) for x in xs]
+
+        # Only send points which have not already been solved to the workers
+        keys = [self._cache_key(x) for x in xs]
+        new = {}
+        for key, x in zip(keys, xs):
+            if key not in self._cache and key not in new:
+                new[key] = x
+        for key, C_D in zip(new.keys(), self._pool.map(_worker_induced_drag, new.values(), [self.alpha]*len(new))):
+            self._cache[key] = C_D
+
+        return [self._cache[key] for key in keys]
+
+
     def get_distributions(self):
         """Returns the resulting lift and load distributions for the optimized wing. These distributions come from MachUpX, not the optimizer, and so have a numch higher resolution.
 
@@ -115,30 +331,12 @@ class TwistOptimizer:
         Sw, cw, bw = self._scene.get_aircraft_reference_geometry()
 
         # Get distributions from MachUpX
-        dist = self._scene.distributions()
-        s = np.array(dist["wing"]["design_section_right"]["span_frac"])*0.5
-        dS = np.array(dist["wing"]["design_section_right"]["area"])
-        c = np.array(dist["wing"]["design_section_right"]["chord"])
-        twist = np.degrees(np.array(dist["wing"]["design_section_right"]["twist"]))
-        Fx = np.array(dist["wing"]["design_section_right"]["Fx"])
-        Fy = np.array(dist["wing"]["design_section_right"]["Fy"])
-        Fz = np.array(dist["wing"]["design_section_right"]["Fz"])
-        CL = np.array(dist["wing"]["design_section_right"]["section_CL"])
-
-        # Calculate lift and drag
-        a = np.radians(self.alpha)
-        L = -Fz*np.cos(a)-Fx*np.sin(a)
-        D = -Fx*np.cos(a)-Fz*np.sin(a)
-
-        # Get CL and CD
-        non_dim = 0.5*self._rho*self._V*self._V*dS
-        #CL = L/non_dim
-        CD = D/non_dim
-
-        # Calculate Cn
-        Cn = np.sqrt(Fz**2+Fy**2)/non_dim
-
-        # Calculate load distribution
-        load = Cn*c/(self._CL*cw)
+        dist = self._scene.distributions()["wing"]["design_section_right"]
+        s, dS, c, twist, Fx, Fy, Fz, CL = (np.asarray(dist[key]) for key in ["span_frac", "area", "chord", "twist", "Fx", "Fy", "Fz", "section_CL"])
+        s = s*0.5
+        twist = np.degrees(twist)
+
+        # Reduce forces to drag and load distributions
+        CD, load = reduce_section_forces(Fx, Fy, Fz, dS, c, self.alpha, 0.5*self._rho*self._V*self._V, self._CL*cw)
 
         return s, twist, CL/self._CL, load
\ No newline at end of file